@@ -1,4 +1,64 @@
-import struct, zlib, yaml, os, collections
+import struct, zlib, os, io, array
+
+# yaml and concurrent.futures are imported where they're used, most commands
+# never need them and they dominate start-up time
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def write_vectored(fh, bufs):
+    """
+    Write a list of buffers to fh, with writev() when fh is backed by a file descriptor
+    """
+    try:
+        fd = fh.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fd = None
+
+    if fd is None or not hasattr(os, "writev"):
+        for buf in bufs:
+            fh.write(buf)
+        return
+
+    fh.flush()
+    bufs = [memoryview(buf) for buf in bufs if len(buf) > 0]
+    i = 0
+    while i < len(bufs):
+        n = os.writev(fd, bufs[i : i + IOV_MAX])
+        # Skip whatever got written, the rest is retried
+        while i < len(bufs) and n >= len(bufs[i]):
+            n -= len(bufs[i])
+            i += 1
+        if n > 0:
+            bufs[i] = bufs[i][n:]
+
+
+def pwrite_all(fd, data, off):
+    data = memoryview(data)
+    while len(data) > 0:
+        n = os.pwrite(fd, data, off)
+        data = data[n:]
+        off += n
+
+
+def pwrite_fw(fd, fw, off, wlen, chunk_size=0x100000):
+    """
+    Copy wlen bytes of a FileWindow to fd at off, a chunk at a time
+    """
+    fh = open(fw.filename, "rb")
+    fh.seek(fw.base_offset, 0)
+    while wlen > 0:
+        data = fh.read(min(chunk_size, wlen))
+        if not data:
+            break
+        pwrite_all(fd, data, off)
+        off += len(data)
+        wlen -= len(data)
+    fh.close()
+
 
 """
 Represents a frame into a file.
@@ -6,6 +66,8 @@ Represents a frame into a file.
 
 
 class FileWindow:
+    __slots__ = ("filename", "base_offset", "pos", "wlen")
+
     def __init__(self, filename, base_offset=0, wlen=None):
         self.filename = filename
         self.base_offset = base_offset
@@ -50,6 +112,8 @@ A generic resource
 
 
 class Resource(object):
+    __slots__ = ("typ", "fw")
+
     def __init__(self, typ, fw):
         self.typ = typ
         self.fw = fw
@@ -73,6 +137,8 @@ A resource within a Package
 
 
 class Element(object):
+    __slots__ = ("typ", "fn", "flags", "is_cmp", "fw")
+
     def __init__(self, typ, fn, flags, is_cmp, fw):
         self.typ = typ
         self.fn = fn
@@ -105,13 +171,18 @@ class Element(object):
             data = zlib.decompress(data)
         return data
 
-    def write(self, fh):
+    def packed(self):
         data = self.unparsed_for_file()
         cmp_len = dec_len = len(data)
 
         if self.is_cmp:
             data = zlib.compress(data, level=9)
             cmp_len = len(data)
+
+        return data, cmp_len, dec_len
+
+    def write(self, fh):
+        data, cmp_len, dec_len = self.packed()
         fh.write(data)
 
         return cmp_len, dec_len
@@ -123,6 +194,8 @@ An empty resource
 
 
 class Empty(Element):
+    __slots__ = ()
+
     def __init__(self, typ, fn, flags):
         super(Empty, self).__init__(typ, fn, flags, False, None)
 
@@ -136,6 +209,8 @@ A TEXture
 
 
 class Texture(Element):
+    __slots__ = ()
+
     def __init__(self, typ, fn, flags, is_cmp, fw):
         super(Texture, self).__init__(typ, fn, flags, is_cmp, fw)
 
@@ -146,6 +221,8 @@ Geometry data
 
 
 class Geometry(Element):
+    __slots__ = ()
+
     def __init__(self, typ, fn, flags, is_cmp, fw):
         super(Geometry, self).__init__(typ, fn, flags, is_cmp, fw)
 
@@ -156,6 +233,8 @@ dARC
 
 
 class ARC(Element):
+    __slots__ = ()
+
     def __init__(self, typ, fn, flags, is_cmp, fw):
         super(ARC, self).__init__(typ, fn, flags, is_cmp, fw)
 
@@ -166,6 +245,8 @@ A TeXT file
 
 
 class TXT(Element):
+    __slots__ = ()
+
     def parsed(self):
         return self.read().decode("sjis")
 
@@ -179,6 +260,108 @@ class TXT(Element):
         return self.unparsed().encode("sjis")
 
 
+"""
+A precomputed layout for SERI bodies sharing the same schema.
+Every scalar value is read with a single unpack_from.
+"""
+
+
+class LayoutPlan(object):
+    __slots__ = ("keys", "etyps", "fmt", "slots", "simple")
+
+    def __init__(self, type_table, keys, val_offs):
+        self.keys = keys
+        self.etyps = [type_table[i : i + 1] for i in range(len(keys))]
+        self.slots = [None] * len(keys)
+        self.fmt = None
+
+        scalars = sorted(
+            (val_offs[i], i)
+            for i, etyp in enumerate(self.etyps)
+            if etyp in SERI.SCALAR_FMTS
+        )
+        fmt = "="
+        pos = 0
+        for slot, (val_off, i) in enumerate(scalars):
+            if val_off < pos:
+                # Overlapping values, leave them to the slow path
+                fmt = None
+                break
+            if val_off > pos:
+                fmt += "%dx" % (val_off - pos)
+            fmt += SERI.SCALAR_FMTS[self.etyps[i]]
+            pos = val_off + struct.calcsize(SERI.SCALAR_FMTS[self.etyps[i]])
+            self.slots[i] = slot
+
+        if scalars and fmt is not None:
+            self.fmt = struct.Struct(fmt)
+
+        # All plain scalars, in order: The dict can be built straight from the tuple
+        self.simple = (
+            self.fmt is not None
+            and len(scalars) == len(keys)
+            and self.slots == list(range(len(keys)))
+            and not any(k in SERI.FN_INDEX for k in keys)
+        )
+
+
+"""
+A precomputed layout for writing SERI bodies of scalar values with the same
+keys and value types. The data is written with a single pack.
+"""
+
+
+class WritePlan(object):
+    DATA = 0
+    FN = 1
+    STR = 2
+
+    __slots__ = ("kinds", "sizes", "fmt", "type_table")
+
+    def __init__(self, kinds, sizes, fmt, type_table):
+        self.kinds = kinds
+        self.sizes = sizes
+        self.fmt = fmt
+        self.type_table = type_table
+
+    @staticmethod
+    def compile(keys, typs):
+        """
+        Returns None if any of the values needs more than a scalar
+        """
+        kinds = []
+        sizes = []
+        fmt = "="
+        type_table = b""
+        for k, typ in zip(keys, typs):
+            if typ == bytes and k not in SERI.FN_INDEX:
+                kinds.append(WritePlan.STR)
+                sizes.append(0)
+                type_table += b"s"
+                continue
+
+            if typ == bytes:
+                kinds.append(WritePlan.FN)
+                etyp = b"i"
+            elif typ == int:
+                kinds.append(WritePlan.DATA)
+                etyp = b"i"
+            elif typ == float:
+                kinds.append(WritePlan.DATA)
+                etyp = b"f"
+            elif typ == bool:
+                kinds.append(WritePlan.DATA)
+                etyp = b"b"
+            else:
+                return None
+
+            fmt += SERI.SCALAR_FMTS[etyp]
+            sizes.append(struct.calcsize(SERI.SCALAR_FMTS[etyp]))
+            type_table += etyp
+
+        return WritePlan(kinds, sizes, struct.Struct(fmt), type_table)
+
+
 """
 A SERIalized YAML object (why?)
 """
@@ -188,6 +371,15 @@ class SERI(Element):
     FN_INDEX = [b"bone", b"smes", b"smat", b"tex", b"hair_length"]
     ARR_FN_INDEX = [b"texi", b"model", b"cloth", b"list"]
     OFF_ENTRY_LEN = struct.calcsize("=2H")
+    SCALAR_FMTS = {b"i": "I", b"f": "f", b"b": "?"}
+    # Key names are shared by most SERI blobs, so keep a single copy of each
+    KEYS = {}
+    # Layout plans are shared by every blob with the same schema
+    PLANS = {}
+    WRITE_PLANS = {}
+    PLAN_STATS = {"hits": 0, "misses": 0, "write_hits": 0, "write_misses": 0}
+
+    __slots__ = ("str_table", "data")
 
     def __init__(self, typ, fn, flags, is_cmp, fw, str_table):
         super(SERI, self).__init__(typ, fn, flags, is_cmp, fw)
@@ -197,68 +389,112 @@ class SERI(Element):
 
     def parse(self, recursive=True):
         self.fw.seek(0x0)
-        typ, data_off, cnt = struct.unpack("=4sIH", self.fw.read(0xA))
+        buf = self.fw.read()
+        typ, data_off, cnt = struct.unpack_from("=4sIH", buf)
         assert typ == b"SERI"
-        self.data = self.parse_body(0xA, 0x4 + data_off, cnt, recursive)
+        self.data = self.parse_body(buf, 0xA, 0x4 + data_off, cnt, recursive)
 
     def unparse(self):
+        import yaml
+
         self.data = yaml.safe_load(self.read())
-        self._index_strings(self.data)
+        for s in self.strings():
+            self.str_table.add_str(s)
 
-    def _index_strings(self, data):
+    def strings(self):
+        """
+        All the keys and string values the data refers to by StrTable offset, in order
+        """
+        ret = {}
+        self._body_strings(self.data, ret)
+        return list(ret)
+
+    def _body_strings(self, data, ret):
         for k, v in data.items():
-            self.str_table.add_str(k)
-            if type(v) == dict:
-                self._index_strings(v)
-            elif type(v) == list and type(v[0]) == dict:
-                for d in v:
-                    self._index_strings(d)
+            ret[k] = None
+            if type(v) == bytes:
+                if k not in SERI.FN_INDEX:
+                    ret[v] = None
+            elif type(v) == list:
+                self._arr_strings(k, v, ret)
+            elif type(v) == dict:
+                self._body_strings(v, ret)
+
+    def _arr_strings(self, k, data, ret):
+        for v in data:
+            if type(v) == bytes:
+                if k not in SERI.ARR_FN_INDEX:
+                    ret[v] = None
+            elif type(v) == list:
+                self._arr_strings(k, v, ret)
+            elif type(v) == dict:
+                self._body_strings(v, ret)
 
     def parsed(self):
+        import yaml
+
         return yaml.dump(self.data).encode('utf8')
 
     def unparsed(self):
         return super(SERI, self).unparsed()
 
-    def parse_body(self, type_table_off, data_off, cnt, recursive=True):
-        self.fw.seek(type_table_off)
-        data = {}  # OrderedDict
+    @staticmethod
+    def get_plan(type_table, keys, val_offs):
+        """
+        Look up the layout plan for a body with this type table, keys and value offsets
+        """
+        scalar_offs = tuple(
+            val_offs[i] for i in range(len(keys)) if type_table[i : i + 1] in SERI.SCALAR_FMTS
+        )
+        sig = (type_table, keys, scalar_offs)
+        plan = SERI.PLANS.get(sig)
+        if plan is not None:
+            SERI.PLAN_STATS["hits"] += 1
+            return plan
+
+        SERI.PLAN_STATS["misses"] += 1
+        plan = SERI.PLANS[sig] = LayoutPlan(type_table, keys, val_offs)
+        return plan
+
+    def parse_body(self, buf, type_table_off, data_off, cnt, recursive=True):
+        off_table = struct.unpack_from("=%dH" % (cnt * 2), buf, type_table_off)
+        type_table = buf[type_table_off + cnt * 4 : type_table_off + cnt * 5]
+        val_offs = off_table[1::2]
+        keys = []
+        for name_off in off_table[0::2]:
+            k = self.str_table[name_off]
+            keys.append(SERI.KEYS.setdefault(k, k))
 
-        off_table = []
-        for i in range(cnt):
-            name_off, val_off = struct.unpack("=2H", self.fw.read(0x4))
-            off_table.append([name_off, val_off])
-        type_table = self.fw.read(cnt)
+        plan = SERI.get_plan(type_table, tuple(keys), val_offs)
+        vals = None
+        if plan.fmt is not None:
+            vals = plan.fmt.unpack_from(buf, data_off)
+            if plan.simple:
+                return dict(zip(plan.keys, vals))
 
-        for i in range(cnt):
-            etyp = type_table[i:i+1]
-            name_off, val_off = off_table[i]
-            k = self.str_table[name_off]
+        data = {}  # OrderedDict
+        for i, k in enumerate(plan.keys):
+            etyp = plan.etyps[i]
+            val_off = val_offs[i]
             val = None
 
             if etyp == b"s":
-                self.fw.seek(data_off + val_off)
-                (val,) = struct.unpack("I", self.fw.read(0x4))
                 val = self.str_table[val_off]
-            elif etyp == b"i":
-                self.fw.seek(data_off + val_off)
-                (val,) = struct.unpack("I", self.fw.read(0x4))
-                if k in SERI.FN_INDEX:
+            elif etyp in SERI.SCALAR_FMTS:
+                if vals is not None:
+                    val = vals[plan.slots[i]]
+                else:
+                    (val,) = struct.unpack_from(
+                        SERI.SCALAR_FMTS[etyp], buf, data_off + val_off
+                    )
+                if etyp == b"i" and k in SERI.FN_INDEX:
                     val = self.str_table.get_str_slot(val - 1)
-            elif etyp == b"f":
-                self.fw.seek(data_off + val_off)
-                (val,) = struct.unpack("f", self.fw.read(0x4))
-            elif etyp == b"b":
-                self.fw.seek(data_off + val_off)
-                (val,) = struct.unpack("?", self.fw.read(0x1))
             elif etyp == b"a":
-                self.fw.seek(data_off + val_off)
-                val = self.read_arr(k, data_off, self.str_table, recursive)
+                val = self.read_arr(buf, k, data_off + val_off, data_off, recursive)
             elif etyp == b"h":
-                self.fw.seek(data_off + val_off)
-                (icnt,) = struct.unpack("H", self.fw.read(0x2))
+                (icnt,) = struct.unpack_from("H", buf, data_off + val_off)
                 val = self.parse_body(
-                    data_off + val_off + 0x2, data_off, icnt, recursive
+                    buf, data_off + val_off + 0x2, data_off, icnt, recursive
                 )
             else:
                 raise (Exception("Unknown type: " + repr(etyp)))
@@ -266,37 +502,38 @@ class SERI(Element):
             data[k] = val
         return data
 
-    def read_arr(self, k, data_off, str_table, recursive=True):
-        atyp, acnt = struct.unpack("=cxH", self.fw.read(0x4))
-        aval_table = struct.unpack("=%dH" % acnt, self.fw.read(acnt * 0x2))
+    def read_arr(self, buf, k, off, data_off, recursive=True):
+        atyp, acnt = struct.unpack_from("=cxH", buf, off)
+        aval_table = struct.unpack_from("=%dH" % acnt, buf, off + 0x4)
 
         ret = []
-        if atyp == b"i":
-            for aval_off in aval_table:
-                self.fw.seek(data_off + aval_off)
-                (val,) = struct.unpack("I", self.fw.read(0x4))
-                if k in SERI.ARR_FN_INDEX:
-                    val = self.str_table.get_str_slot(val - 1)
-                ret.append(val)
-        elif atyp == b"f":
-            for aval_off in aval_table:
-                self.fw.seek(data_off + aval_off)
-                ret.append(struct.unpack("f", self.fw.read(0x4))[0])
+        if atyp == b"i" or atyp == b"f":
+            fmt = SERI.SCALAR_FMTS[atyp]
+            if acnt > 0 and aval_table == tuple(
+                range(aval_table[0], aval_table[0] + acnt * 0x4, 0x4)
+            ):
+                # Packed back to back, which is how they're usually written
+                ret = list(
+                    struct.unpack_from("=%d%s" % (acnt, fmt), buf, data_off + aval_table[0])
+                )
+            else:
+                for aval_off in aval_table:
+                    ret.append(struct.unpack_from(fmt, buf, data_off + aval_off)[0])
+            if atyp == b"i" and k in SERI.ARR_FN_INDEX:
+                ret = [self.str_table.get_str_slot(val - 1) for val in ret]
         elif atyp == b"a":
             for aval_off in aval_table:
-                self.fw.seek(data_off + aval_off)
-                ret.append(self.read_arr(k, data_off, str_table))
+                ret.append(self.read_arr(buf, k, data_off + aval_off, data_off))
 
         elif atyp == b"s":
             for aval_off in aval_table:
                 ret.append(self.str_table[aval_off])
         elif atyp == b"h":
             for aval_off in aval_table:
-                self.fw.seek(data_off + aval_off)
-                (icnt,) = struct.unpack("H", self.fw.read(0x2))
+                (icnt,) = struct.unpack_from("H", buf, data_off + aval_off)
 
                 aval = self.parse_body(
-                    data_off + aval_off + 0x2, data_off, icnt, recursive
+                    buf, data_off + aval_off + 0x2, data_off, icnt, recursive
                 )
                 ret.append(aval)
         else:
@@ -316,11 +553,62 @@ class SERI(Element):
 
         return 0x0, 0xA + data_off + sz
 
+    def packed(self):
+        # The body is written out of order, so serialize it into a buffer first
+        fh = io.BytesIO()
+        cmp_len, dec_len = self.write(fh)
+        return fh.getvalue(), cmp_len, dec_len
+
+    @staticmethod
+    def get_write_plan(data):
+        """
+        Look up the write plan for a body with these keys and value types
+        """
+        sig = (tuple(data), tuple(type(v) for v in data.values()))
+        if sig in SERI.WRITE_PLANS:
+            SERI.PLAN_STATS["write_hits"] += 1
+            return SERI.WRITE_PLANS[sig]
+
+        SERI.PLAN_STATS["write_misses"] += 1
+        plan = SERI.WRITE_PLANS[sig] = WritePlan.compile(*sig)
+        return plan
+
+    def write_plan(self, fh, plan, abs_off, data_abs_off, data_off, data):
+        entries = []
+        vals = []
+        curr_off = data_off
+        for (k, v), kind, size in zip(data.items(), plan.kinds, plan.sizes):
+            entries.append(self.str_table.find_str(k))
+            if kind == WritePlan.STR:
+                entries.append(self.str_table.find_str(v))
+                continue
+
+            entries.append(curr_off)
+            curr_off += size
+            if kind == WritePlan.FN:
+                v = self.str_table.find_str_slot(v) + 1
+            vals.append(v)
+
+        fh.seek(data_abs_off + data_off)
+        fh.write(plan.fmt.pack(*vals))
+        fh.seek(abs_off)
+        fh.write(struct.pack("=%dH" % len(entries), *entries) + plan.type_table)
+
+        return curr_off
+
     def write_body(self, fh, data_abs_off, data_off, data):
         abs_off = fh.tell()
         type_table_off = self.OFF_ENTRY_LEN * len(data)
         curr_off = data_off
 
+        plan = SERI.get_write_plan(data)
+        if plan is not None:
+            table_end = abs_off + type_table_off + len(data)
+            data_start = data_abs_off + data_off
+            # Nested bodies can overlap their own data, where write order matters
+            if table_end <= data_start or data_start + plan.fmt.size <= abs_off:
+                return self.write_plan(fh, plan, abs_off, data_abs_off, data_off, data)
+
         i = 0
         for k, v in data.items():
             name_off = self.str_table.find_str(k)
@@ -431,10 +719,14 @@ class SERI(Element):
 
 
 class StrTable(object):
+    # offs memoizes find_str/add_str, but only while a package is being written (See memoize())
+    __slots__ = ("data", "slots", "map", "offs")
+
     def __init__(self, data=b""):
         self.data = data
         self.slots = []
         self.map = {}
+        self.offs = None
 
     def __getitem__(self, pos):
         end = self.data.index(b"\0", pos)
@@ -444,22 +736,43 @@ class StrTable(object):
         self.data = data
         self.slots = list(slots)
         self.map = {}
+        if self.offs is not None:
+            self.offs = {}
 
         for i, v in enumerate(self.slots):
             if self[v] not in self.map:
                 self.map[self[v]] = i
 
+    def memoize(self, enable=True):
+        """
+        Start (or stop) memoizing string offsets. Packing looks up the same keys over and over,
+        but keeping the memo around afterwards costs more memory than it's worth
+        """
+        self.offs = {} if enable else None
+
     def find_str(self, s):
-        return self.data.index(s + b"\0")
+        if self.offs is None:
+            return self.data.index(s + b"\0")
+        idx = self.offs.get(s)
+        if idx is None:
+            idx = self.offs[s] = self.data.index(s + b"\0")
+        return idx
 
     def add_str(self, s):
         if isinstance(s, str):
             s = s.encode('utf8')
+        if self.offs is not None:
+            idx = self.offs.get(s)
+            if idx is not None:
+                return idx
+
         s0 = s + b"\0"
         idx = self.data.find(s0)
         if idx == -1:
             idx = len(self.data)
             self.data += s0
+        if self.offs is not None:
+            self.offs[s] = idx
 
         return idx
 
@@ -477,11 +790,172 @@ class StrTable(object):
         self.data = b""
         self.slots = []
         self.map = {}
+        if self.offs is not None:
+            self.offs = {}
 
     def clear_slots(self):
         self.slots = []
         self.map = {}
 
+    def host(self, pos):
+        """
+        Start of the string containing pos. Lookups can land in the tail of a longer string
+        """
+        return self.data.rfind(b"\0", 0, pos) + 1
+
+    def compact(self, strs):
+        """
+        Drop every string that neither a slot nor anything in strs refers to.
+        The order of everything left is kept. Returns whether anything was dropped
+        """
+        keep = set(self.host(v) for v in self.slots)
+        for s in strs:
+            if isinstance(s, str):
+                s = s.encode("utf8")
+            keep.add(self.host(self.find_str(s)))
+
+        data = []
+        remap = {}
+        pos = 0
+        new_pos = 0
+        while pos < len(self.data):
+            end = self.data.find(b"\0", pos) + 1
+            if end == 0:
+                end = len(self.data)
+            if pos in keep:
+                remap[pos] = new_pos
+                data.append(self.data[pos:end])
+                new_pos += end - pos
+            pos = end
+
+        if new_pos == len(self.data):
+            return False
+
+        slots = []
+        for v in self.slots:
+            host = self.host(v)
+            slots.append(remap[host] + v - host)
+
+        # Slot indices don't move
+        str_map = self.map
+        self.update(b"".join(data), slots)
+        self.map = str_map
+        return True
+
+
+"""
+The entry table of a Package, stored as parallel arrays.
+Elements are only created when first accessed.
+"""
+
+
+class ElementTable(object):
+    __slots__ = (
+        "filename",
+        "base_offset",
+        "str_table",
+        "typs",
+        "flags",
+        "is_cmp",
+        "offs",
+        "lens",
+        "elems",
+        "src_cnt",
+    )
+
+    def __init__(self, fw, str_table):
+        self.filename = None if fw is None else fw.filename
+        self.base_offset = 0 if fw is None else fw.base_offset
+        self.str_table = str_table
+        self.typs = []
+        self.flags = array.array("I")
+        self.is_cmp = array.array("I")
+        self.offs = array.array("I")
+        self.lens = array.array("I")
+        self.elems = []
+        # Entries read from the source package, the rest were appended
+        self.src_cnt = 0
+
+    def __len__(self):
+        return len(self.typs)
+
+    def __getitem__(self, i):
+        elem = self.elems[i]
+        if elem is None:
+            elem = self.elems[i] = self.make_element(i)
+        return elem
+
+    def __setitem__(self, i, elem):
+        self.elems[i] = elem
+
+    def __iter__(self):
+        for i in range(len(self.typs)):
+            yield self[i]
+
+    def add(self, typ, flags, is_cmp, off, wlen):
+        self.typs.append(typ)
+        self.flags.append(flags)
+        self.is_cmp.append(is_cmp)
+        self.offs.append(off)
+        self.lens.append(wlen)
+        self.elems.append(None)
+        self.src_cnt += 1
+
+    def append(self, elem):
+        self.typs.append(elem.typ)
+        self.flags.append(elem.flags)
+        self.is_cmp.append(elem.is_cmp)
+        self.offs.append(0)
+        self.lens.append(0)
+        self.elems.append(elem)
+
+    def original(self, i):
+        """
+        The raw bytes of entry i in the source package, None if it was appended
+        """
+        if self.filename is None or i >= self.src_cnt:
+            return None
+        return FileWindow(self.filename, self.base_offset + self.offs[i], self.lens[i]).read()
+
+    def get_fn(self, i):
+        elem = self.elems[i]
+        if elem is not None:
+            return elem.fn
+        return self.str_table.get_str_slot(i).decode("utf8")
+
+    def make_element(self, i):
+        typ = self.typs[i]
+        flags = self.flags[i]
+        is_cmp = self.is_cmp[i]
+        fw = FileWindow(self.filename, self.base_offset + self.offs[i], self.lens[i])
+        fn = self.str_table.get_str_slot(i).decode("utf8")
+
+        elem = None
+        if typ in [b"TEXI", b"YAML", b"MDL "]:
+            elem = SERI(
+                typ,
+                fn,
+                flags,
+                is_cmp,
+                fw,
+                self.str_table,
+            )
+        elif typ in [b"    "]:
+            elem = Empty(typ, fn, flags)
+        elif typ in [b"TXT "]:
+            elem = TXT(typ, fn, flags, is_cmp, fw)
+            elem.read()
+        elif typ in [b"TEX "]:
+            elem = Texture(typ, fn, flags, is_cmp, fw)
+        elif typ in [b"SMES", b"SMAT"]:
+            elem = Geometry(typ, fn, flags, is_cmp, fw)
+        elif typ in [b"ARC "]:
+            elem = ARC(typ, fn, flags, is_cmp, fw)
+        else:
+            elem = Element(typ, fn, flags, is_cmp, fw)
+
+        return elem
+
 
 """
 A Package resource
@@ -495,14 +969,29 @@ class Package(Resource):
     LARGE_BLOCK_SIZE = 0x80
     LARGE_BLOCK_MASK = LARGE_BLOCK_SIZE - 1
 
+    __slots__ = (
+        "typ0",
+        "dec_len",
+        "dec_data_off",
+        "unk",
+        "entries",
+        "str_table",
+        "cache",
+        "compact_strs",
+    )
+
     def __init__(self, fw, unk):
         super(Package, self).__init__(b"PAK ", fw)
         self.typ0 = True
         self.dec_len = 0x0
         self.dec_data_off = 0x0
         self.unk = unk  # ???: Either 128 or 0
-        self.entries = []
         self.str_table = StrTable()
+        self.entries = ElementTable(fw, self.str_table)
+        # Packed element data by index. Only used when set to a dict
+        self.cache = None
+        # Compact the StrTable even if no SERI data changed
+        self.compact_strs = False
 
     def parse(self, recursive=True):
         self.fw.seek(0x0)
@@ -531,6 +1020,7 @@ class Package(Resource):
         )
         self.fw.seek(off)
 
+        self.entries = ElementTable(self.fw, self.str_table)
         for i in range(cnt):
             (
                 typ,
@@ -543,56 +1033,76 @@ class Package(Resource):
             ) = Package.parse_entry(self.fw.read(Package.ENTRY_SIZE))
             elem_off = cmp_off if is_cmp else dec_off
             elem_len = cmp_len if is_cmp else dec_len
-            fw = FileWindow(self.fw.filename, self.fw.base_offset + elem_off, elem_len)
-            off = self.fw.tell()
-            self.fw.seek(elem_off)
-
-            elem = None
-            fn = self.str_table.get_str_slot(i).decode('utf8')
-            if typ in [b"TEXI", b"YAML", b"MDL "]:
-                elem = SERI(
-                    typ,
-                    fn,
-                    flags,
-                    is_cmp,
-                    fw,
-                    self.str_table,
-                )
-            elif typ in [b"    "]:
-                elem = Empty(typ, fn, flags)
-            elif typ in [b"TXT "]:
-                elem = TXT(typ, fn, flags, is_cmp, fw)
-                elem.read()
-            elif typ in [b"TEX "]:
-                elem = Texture(typ, fn, flags, is_cmp, fw)
-            elif typ in [b"SMES", b"SMAT"]:
-                elem = Geometry(typ, fn, flags, is_cmp, fw)
-            elif typ in [b"ARC "]:
-                elem = ARC(typ, fn, flags, is_cmp, fw)
-            else:
-                elem = Element(typ, fn, flags, is_cmp, fw)
+            self.entries.add(typ, flags, is_cmp, elem_off, elem_len)
 
-            self.fw.seek(off)
-            if recursive:
+        if recursive:
+            for elem in self.entries:
                 elem.parse(recursive)
 
-            self.entries.append(elem)
+    @staticmethod
+    def used_strings(elems):
+        """
+        The set of strings the SERI data of elems refers to
+        """
+        strs = set()
+        for elem in elems:
+            if type(elem) != SERI:
+                continue
+            for v in elem.strings():
+                strs.add(v.encode("utf8") if isinstance(v, str) else v)
+        return strs
 
-    def write(self, fh):
-        abs_off = fh.tell()
-        # self.str_table.clear() # FIXME: We're not clearing the str table here because the order seems to be significant
+    def seri_changed(self, seri):
+        """
+        Whether any SERI element (Given as index: packed) differs from the source package
+        """
+        # Nothing to compare against in a package that was built from scratch
+        if self.entries.filename is None:
+            return False
+        for i, (data, cmp_len, dec_len) in seri.items():
+            # The tail of the data isn't always written, it reads back as zeros
+            if self.entries.original(i) != data + b"\0" * (dec_len - len(data)):
+                return True
+        return False
+
+    def layout(self):
+        """
+        Lay out the whole package. Returns a list of (offset, data) chunks in ascending order
+        """
+        # The str table isn't rebuilt from scratch because the slot order is significant. It's compacted instead
 
         str_table_off = (len(self.entries) + 1) * Package.ENTRY_SIZE
         #        for elem in self.entries:
         #            self.str_table.push_str_slot(elem.fn)
 
-        for elem in self.entries:
-            elem.unparse()
+        for i, elem in enumerate(self.entries):
+            if self.cache is None or i not in self.cache:
+                elem.unparse()
 
-        fh.seek(abs_off + str_table_off)
-        fh.write(self.str_table.data)
+        seri = {}
+        for i, elem in enumerate(self.entries):
+            if type(elem) == SERI:
+                seri[i] = self.pack_element(i, elem)
+
+        # Drop strings left behind by removed or renamed keys and values. As long as
+        # no SERI data changed the table is kept as is, unused strings and all
+        if self.compact_strs or self.seri_changed(seri):
+            if self.str_table.compact(Package.used_strings(self.entries)):
+                # Offsets moved, so the packed SERI data is stale
+                for i in seri:
+                    if self.cache is not None:
+                        self.cache.pop(i, None)
+                    seri[i] = self.pack_element(i, self.entries[i])
+
+        chunks = [None]
+        chunks.append(
+            (
+                str_table_off,
+                self.str_table.data
+                + struct.pack("=%dI" % len(self.str_table.slots), *self.str_table.slots),
+            )
+        )
         ptr_off = str_table_off + len(self.str_table.data)
-        fh.write(struct.pack("=%dI" % len(self.str_table.slots), *self.str_table.slots))
         curr_off = data_off = self.NEXT_BLOCK_ADDR(
             ptr_off + 0x4 * len(self.str_table.slots)
         )
@@ -601,8 +1111,8 @@ class Package(Resource):
         for i, elem in enumerate(self.entries):
             if type(elem) != SERI:
                 continue
-            fh.seek(abs_off + curr_off)
-            cmp_len, dec_len = elem.write(fh)
+            data, cmp_len, dec_len = seri[i]
+            chunks.append((curr_off, data))
             elem_pos_table[i] = (cmp_len, dec_len, 0, curr_off)
             curr_off = self.NEXT_BLOCK_ADDR(curr_off + dec_len)
 
@@ -614,7 +1124,6 @@ class Package(Resource):
                 continue
 
             is_lrg = type(elem) in [Texture, Geometry, ARC]
-            fh.seek(abs_off + curr_off)
             dec_curr_data_off = self.NEXT_BLOCK_ADDR(dec_curr_off, is_lrg)
             delta = dec_curr_data_off - dec_curr_off
             if is_lrg and delta > 0:
@@ -622,28 +1131,26 @@ class Package(Resource):
                 if len(chunk_data) > delta:
                     chunk_data = b"\0" * delta
 
-                fh.write(chunk_data)
+                chunks.append((curr_off, chunk_data))
                 curr_off = self.NEXT_BLOCK_ADDR(curr_off + len(chunk_data))
-                fh.seek(abs_off + curr_off)
                 assert (curr_off & 0xF) == 0
             dec_curr_off = dec_curr_data_off
 
-            cmp_len, dec_len = elem.write(fh)
+            data, cmp_len, dec_len = self.pack_element(i, elem)
 
             elem_pos_table[i] = (cmp_len, dec_len, curr_off, dec_curr_off)
+            elem_off = curr_off
             curr_data_off = curr_off + cmp_len
             curr_off = self.NEXT_BLOCK_ADDR(curr_data_off)
             dec_curr_off = self.NEXT_BLOCK_ADDR(dec_curr_off + dec_len)
 
-            fh.seek(abs_off + curr_data_off)
-            if curr_off > curr_data_off:
-                fh.write(b"\0" * (curr_off - curr_data_off))
+            # Pad to the next block
+            chunks.append((elem_off, data + b"\0" * (curr_off - curr_data_off)))
 
         self.dec_len = dec_curr_off
         self.dec_data_off = dec_data_off
 
-        fh.seek(abs_off)
-        fh.write(
+        header = [
             struct.pack(
                 "=6sH6I",
                 b"PACK\n" + b"0" if self.typ0 else b" ",
@@ -655,11 +1162,11 @@ class Package(Resource):
                 curr_off,
                 0,
             )
-        )
+        ]
 
         for i, elem in enumerate(self.entries):
             cmp_len, dec_len, cmp_off, dec_off = elem_pos_table[i]
-            fh.write(
+            header.append(
                 struct.pack(
                     "=4s4x6I",
                     elem.typ,
@@ -671,6 +1178,39 @@ class Package(Resource):
                     cmp_off if elem.is_cmp else 0x0,
                 )
             )
+        chunks[0] = (0x0, b"".join(header))
+
+        return chunks
+
+    def pack_element(self, i, elem):
+        if self.cache is None:
+            return elem.packed()
+        if i not in self.cache:
+            self.cache[i] = elem.packed()
+        return self.cache[i]
+
+    def write(self, fh):
+        """
+        Write the package sequentially. fh doesn't need to be seekable
+        """
+        bufs = []
+        pos = 0x0
+        self.str_table.memoize()
+        try:
+            chunks = self.layout()
+        finally:
+            self.str_table.memoize(False)
+        for i, (off, data) in enumerate(chunks):
+            # Unwritten gaps read back as zeros
+            if off > pos:
+                bufs.append(b"\0" * (off - pos))
+            # A chunk running past the start of the next one gets overwritten by it
+            if i + 1 < len(chunks) and off + len(data) > chunks[i + 1][0]:
+                data = memoryview(data)[: chunks[i + 1][0] - off]
+            bufs.append(data)
+            pos = off + len(data)
+
+        write_vectored(fh, bufs)
 
     @staticmethod
     def parse_header(data):
@@ -724,6 +1264,8 @@ class Image(object):
         self.filename = filename
         self.fh = open(filename, "rb+")
         self.entries = []
+        # Block aligned (start, end) addresses of each resource, from the last write
+        self.spans = {}
 
     def parse(self, recursive=True):
         """
@@ -799,72 +1341,143 @@ class Image(object):
             self.entries.append(res)
             self.fh.seek(off, 0)
 
-    def write(self, fh):
+    def layout(self):
         """
-        Write the image file
+        Assign every resource its blocks, based on the size of its data
+        Returns the file header, the index & offset tables, the (idx, addr, len) of each resource and the total size
         """
-        # Skip over the file header for now, we'll fill it out later
-        fh.seek(self.IDX_TABLE_ADDR, 0)
-
         idx_table_entry_count = len(self.entries)
 
-        # Generate and write the index table
-        for idx, res in enumerate(self.entries):
-            typ, num1, num2, num3, num4 = b"\0\0\0\0", 0x0, 0x0, 0x0, 0x8
-            if res is not None:
-                typ, num1, num2, num3, num4 = res.get_header()
-            fh.write(struct.pack("=4s4x2I2xBB", typ, num1, num2, num3, num4))
+        # Generate the index table
+        idx_table = b"".join(Image.pack_idx_entry(res) for res in self.entries)
 
-        off_table_offset = fh.tell() - self.IDX_TABLE_ADDR
+        off_table_offset = len(idx_table)
         off_table_entry_count = len([i for i in self.entries if i is not None])
         # ???: An unknown pointer into the middle of the index table. Modifying it causes the game to crash on boot. The value is exactly 0x800 bytes (1 BLOCK_SIZE) less than the start of the offset table.
         unk = 0x1C4B4
 
-        fh.write(struct.pack("=4x2I", off_table_entry_count, unk))
+        off_table = [struct.pack("=4x2I", off_table_entry_count, unk)]
 
-        next_empty_addr = self.NEXT_BLOCK_ADDR(
-            fh.tell() + struct.calcsize("=2I") * off_table_entry_count
+        tables_end = (
+            self.IDX_TABLE_ADDR
+            + off_table_offset
+            + struct.calcsize("=4x2I")
+            + struct.calcsize("=2I") * off_table_entry_count
         )
+        next_empty_addr = self.NEXT_BLOCK_ADDR(tables_end)
         data_start_block = self.ADDR_NUM_BLOCK(next_empty_addr)
 
-        # Generate and write the offset table & its targets
-
+        # Generate the offset table & place its targets
+        self.spans = {}
+        addrs = []
         for idx, res in enumerate(self.entries):
             if res is None:
                 continue
-            fh.write(struct.pack("=2I", idx, self.ADDR_NUM_BLOCK(next_empty_addr)))
-            off = fh.tell()
+            off_table.append(struct.pack("=2I", idx, self.ADDR_NUM_BLOCK(next_empty_addr)))
 
-            # Write resource
-            fh.seek(next_empty_addr, 0)
-            res.fw.seek(0x0)
-            fh.write(res.fw.read())
-            next_empty_addr = self.NEXT_BLOCK_ADDR(fh.tell())
+            wlen = res.fw.len()
+            addrs.append((idx, next_empty_addr, wlen))
+            res_addr = next_empty_addr
+            next_empty_addr = self.NEXT_BLOCK_ADDR(next_empty_addr + wlen)
+            self.spans[idx] = (res_addr, next_empty_addr)
 
-            # Pad to next block
-            fh.write(b"\0" * (next_empty_addr - fh.tell()))
-
-            fh.seek(off)
-
-        # Write the file header
         # ???: All these constants are unknown
-        fh.seek(0x0, 0)
-        fh.write(
-            struct.pack(
-                "=10I",
-                0xA,
-                data_start_block,
-                0x1,
-                0x0,
-                idx_table_entry_count,
-                off_table_offset,
-                0x1,
-                0x0,
-                0x0,
-                0x276F4, # ???: Doesn't affect game boot
-            )
+        header = struct.pack(
+            "=10I",
+            0xA,
+            data_start_block,
+            0x1,
+            0x0,
+            idx_table_entry_count,
+            off_table_offset,
+            0x1,
+            0x0,
+            0x0,
+            0x276F4, # ???: Doesn't affect game boot
         )
 
+        total_len = next_empty_addr if addrs else tables_end
+        return header, idx_table + b"".join(off_table), addrs, total_len
+
+    def write(self, fh, jobs=1):
+        """
+        Write the image file
+        With jobs > 1, resources are copied in parallel into a preallocated file
+        """
+        header, tables, addrs, total_len = self.layout()
+
+        fd = None
+        if jobs > 1 and hasattr(os, "pwrite"):
+            try:
+                fd = fh.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                pass
+
+        if fd is None:
+            fh.seek(0x0, 0)
+            fh.write(header)
+            fh.seek(self.IDX_TABLE_ADDR, 0)
+            fh.write(tables)
+
+            for idx, addr, wlen in addrs:
+                res = self.entries[idx]
+                fh.seek(addr, 0)
+                res.fw.seek(0x0)
+                fh.write(res.fw.read())
+
+                # Pad to next block
+                fh.write(b"\0" * (self.NEXT_BLOCK_ADDR(fh.tell()) - fh.tell()))
+            return
+
+        # Gaps and padding are left as the zeros the file is allocated with
+        fh.flush()
+        os.ftruncate(fd, 0)
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, total_len)
+        else:
+            os.ftruncate(fd, total_len)
+
+        pwrite_all(fd, header, 0x0)
+        pwrite_all(fd, tables, self.IDX_TABLE_ADDR)
+
+        import concurrent.futures
+
+        pool = concurrent.futures.ThreadPoolExecutor(jobs)
+        futures = [
+            pool.submit(pwrite_fw, fd, self.entries[idx].fw, addr, wlen)
+            for idx, addr, wlen in addrs
+        ]
+        pool.shutdown()
+        for future in futures:
+            future.result()
+
+    def update(self, fh, idx):
+        """
+        Rewrite a single resource of an img written by write() in place
+        Returns False if the resource no longer fits in its blocks
+        """
+        addr, end_addr = self.spans[idx]
+        res = self.entries[idx]
+        res.fw.seek(0x0)
+        data = res.fw.read()
+        if addr + len(data) > end_addr:
+            return False
+
+        fh.seek(addr, 0)
+        fh.write(data)
+        fh.write(b"\0" * (end_addr - addr - len(data)))
+
+        fh.seek(self.IDX_TABLE_ADDR + idx * self.IDX_TABLE_ENTRY_SIZE, 0)
+        fh.write(Image.pack_idx_entry(res))
+        return True
+
+    @staticmethod
+    def pack_idx_entry(res):
+        typ, num1, num2, num3, num4 = b"\0\0\0\0", 0x0, 0x0, 0x0, 0x8
+        if res is not None:
+            typ, num1, num2, num3, num4 = res.get_header()
+        return struct.pack("=4s4x2I2xBB", typ, num1, num2, num3, num4)
+
     @staticmethod
     def parse_idx_entry(data):
         typ, num1, num2, num3, num4 = struct.unpack("=4s4x2I2xBB", data)
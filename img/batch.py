@@ -0,0 +1,127 @@
+import os, shlex, time
+
+from img import Image, Package, FileWindow
+from img import cli
+
+"""
+Runs a list of pe/ie jobs in a single process.
+
+Each line of a job file is a bin/pe or bin/ie command line, without the
+"bin/". Only list, unpack and repack are supported. Blank lines and # comments
+are skipped:
+
+    ie --src_img img.bin unpack --idx 1 2
+    pe img_data/0001 unpack
+    pe img_data/0002 --dst_pkg out/0002 list
+
+Parsed images and packages are kept between jobs for as long as their file is
+unchanged, as are the SERI layout plans. A repack edits the parsed copy in
+place, so it's dropped afterwards.
+"""
+
+
+def file_sig(fn):
+    st = os.stat(fn)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class Batch(object):
+    def __init__(self):
+        self.pe_parser = cli.pe_parser()
+        self.ie_parser = cli.ie_parser()
+        self.imgs = {}
+        self.pkgs = {}
+        self.done = 0
+        self.failed = 0
+
+    def image(self, fn):
+        sig = file_sig(fn)
+        cached = self.imgs.get(fn)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+
+        print("[+] Parsing img")
+        img = Image(fn)
+        img.parse(False)
+        self.imgs[fn] = (sig, img)
+        return img
+
+    def package(self, fn):
+        sig = file_sig(fn)
+        cached = self.pkgs.get(fn)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+
+        pkg = Package(FileWindow(fn), 0)
+        pkg.parse(False)
+        self.pkgs[fn] = (sig, pkg)
+        return pkg
+
+    def run_pe(self, argv):
+        args = cli.pe_args(self.pe_parser, argv)
+        pkg = self.package(args.src_pkg)
+
+        if args.cmd == "list":
+            cli.list_pkg(pkg)
+        elif args.cmd == "unpack":
+            entries = cli.select(pkg.entries, args.idx)
+            cli.unpack_pkg(pkg, entries, args.pkg_dir, args.store)
+        elif args.cmd == "repack":
+            self.pkgs.pop(args.src_pkg, None)
+            cli.repack_pkg(pkg, args.pkg_dir, args.dst_pkg, args.compact)
+        else:
+            raise (Exception("Unsupported pe command: " + str(args.cmd)))
+
+    def run_ie(self, argv):
+        args = self.ie_parser.parse_args(argv)
+        if args.cmd not in ["unpack", "repack"]:
+            raise (Exception("Unsupported ie command: " + str(args.cmd)))
+
+        img = self.image(args.src_img)
+        entries = cli.select(img.entries, args.idx)
+
+        if args.cmd == "unpack":
+            cli.unpack_img(entries, args.img_dir)
+        elif args.cmd == "repack":
+            self.imgs.pop(args.src_img, None)
+            cli.repack_img(img, entries, args.img_dir, args.dst_img, args.jobs)
+
+    def run_job(self, argv):
+        if argv[0] == "pe":
+            self.run_pe(argv[1:])
+        elif argv[0] == "ie":
+            self.run_ie(argv[1:])
+        else:
+            raise (Exception("Unknown tool: " + argv[0]))
+
+    def run(self, fh, stop=False):
+        """
+        Run every job in fh. Returns the number of failed jobs
+        """
+        for line_no, line in enumerate(fh, 1):
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+
+            print("[+] Job %d: %s" % (line_no, " ".join(argv)))
+            t = time.time()
+            err = None
+            try:
+                self.run_job(argv)
+            except SystemExit:
+                # argparse exits on bad arguments, after printing the usage
+                err = "Bad arguments"
+            except Exception as e:
+                err = str(e)
+
+            if err is None:
+                self.done += 1
+                print("[+] Job %d done in %.2fs" % (line_no, time.time() - t))
+                continue
+
+            print("[-] Job %d failed: %s" % (line_no, err))
+            self.failed += 1
+            if stop:
+                break
+
+        return self.failed
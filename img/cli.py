@@ -0,0 +1,291 @@
+import os, argparse
+
+from img import FileWindow, SERI
+
+"""
+The arguments and the list/unpack/repack commands of bin/pe and bin/ie.
+
+Kept out of the scripts so that bin/nlpp batch can run the same commands, with
+the same arguments, many times over in a single process.
+"""
+
+
+def package_fn(img_dir, i, new=False):
+    return "%s/%s%04d" % (img_dir, "new_" if new else "", i)
+
+
+def element_fn(pkg_dir, fn, metadata):
+    if metadata:
+        fn += ".seri"
+    return "%s/%s" % (pkg_dir, fn)
+
+
+class IdxNotFound(Exception):
+    pass
+
+
+class IdxEmpty(Exception):
+    pass
+
+
+def select(entries, idxs):
+    """
+    The (idx, entry) pairs for idxs, or all of them if idxs is None
+    """
+    if idxs is None:
+        return list(enumerate(entries))
+
+    ret = []
+    for i in idxs:
+        if i < 0 or i >= len(entries):
+            raise (IdxNotFound('Idx "%04d" not found!' % i))
+        if entries[i] is None:
+            raise (IdxEmpty('Idx "%04d" is empty!' % i))
+        ret.append((i, entries[i]))
+    return ret
+
+
+def pe_parser():
+    parser = argparse.ArgumentParser("NLPP package manipulation script")
+    parser.add_argument("src_pkg", help="Source package file")
+
+    subparsers = parser.add_subparsers(title="subcommands", dest="cmd")
+
+    list_parser = subparsers.add_parser("list", help="List resources")
+
+    unpack_parser = subparsers.add_parser("unpack", help="Unpack resources")
+    unpack_parser.add_argument(
+        "--idx", type=int, nargs="+", help="Unpack a specific resource"
+    )
+    unpack_parser.add_argument(
+        "--store", help="Deduplicate resources into this object store", default=None
+    )
+
+    repack_parser = subparsers.add_parser("repack", help="Repack resources")
+    repack_parser.add_argument(
+        "--idx", type=int, nargs="+", help="Repack a specific resource"
+    )
+    repack_parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Drop unused strings even if the package wasn't edited",
+    )
+
+    parser.add_argument("--pkg_dir", help="Directory with unpacked data", default=None)
+    parser.add_argument("--dst_pkg", help="Destination package file", default=None)
+    return parser
+
+
+def pe_args(parser, argv=None):
+    args = parser.parse_args(argv)
+    if args.pkg_dir is None:
+        args.pkg_dir = args.src_pkg + "_data"
+    if args.dst_pkg is None:
+        path, fn = os.path.split(args.src_pkg)
+        args.dst_pkg = os.path.join(path, "new_" + fn)
+    return args
+
+
+def ie_parser():
+    parser = argparse.ArgumentParser("NLPP img manipulation script")
+    parser.add_argument("--src_img", help="Source img file", default="img.bin")
+    parser.add_argument(
+        "--img_dir", help="Directory with unpacked data", default="img_data"
+    )
+
+    subparsers = parser.add_subparsers(title="subcommands", dest="cmd")
+
+    unpack_parser = subparsers.add_parser(
+        "unpack", help="Unpack resources (Defaults to all)"
+    )
+    unpack_parser.add_argument(
+        "--idx", type=int, nargs="+", help="Unpack a specific resource"
+    )
+
+    repack_parser = subparsers.add_parser(
+        "repack", help="Repack resources (Defaults to all)"
+    )
+    repack_parser.add_argument(
+        "--idx", type=int, nargs="+", help="Repack a specific resource"
+    )
+    repack_parser.add_argument(
+        "--dst_img", help="Destination img file", default="new_img.bin"
+    )
+    repack_parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Number of resources to write in parallel",
+        default=os.cpu_count() or 1,
+    )
+
+    diff_parser = subparsers.add_parser(
+        "diff", help="Generate a patch from the source img to a modified img"
+    )
+    diff_parser.add_argument(
+        "--dst_img", help="Modified img file", default="new_img.bin"
+    )
+    diff_parser.add_argument(
+        "--patch", help="Destination patch file", default="img.patch"
+    )
+
+    patch_parser = subparsers.add_parser(
+        "patch", help="Apply a patch to the source img"
+    )
+    patch_parser.add_argument("--patch", help="Source patch file", default="img.patch")
+    patch_parser.add_argument(
+        "--dst_img", help="Destination img file ('-' for stdout)", default="new_img.bin"
+    )
+
+    watch_parser = subparsers.add_parser(
+        "watch", help="Rebuild the img as unpacked packages change (Defaults to all)"
+    )
+    watch_parser.add_argument(
+        "--idx", type=int, nargs="+", help="Watch a specific resource"
+    )
+    watch_parser.add_argument(
+        "--dst_img", help="Destination img file", default="new_img.bin"
+    )
+    watch_parser.add_argument(
+        "--interval", type=float, help="Seconds between polls", default=0.5
+    )
+
+    index_parser = subparsers.add_parser(
+        "index", help="Build a search index of package strings (Defaults to all)"
+    )
+    index_parser.add_argument(
+        "--idx", type=int, nargs="+", help="Index a specific resource"
+    )
+    index_parser.add_argument("--index", help="Index file", default="img.idx")
+
+    search_parser = subparsers.add_parser("search", help="Search the index")
+    search_parser.add_argument("query", help="String to search for")
+    search_parser.add_argument(
+        "--exact", action="store_true", help="Only match whole strings"
+    )
+    search_parser.add_argument("--index", help="Index file", default="img.idx")
+    return parser
+
+
+def list_pkg(pkg):
+    for i in range(len(pkg.entries)):
+        print(pkg.entries.get_fn(i))
+
+
+def unpack_pkg(pkg, entries, pkg_dir, store_path=None):
+    # store imports hashlib, which list doesn't need
+    from img import store
+
+    if not os.path.exists(pkg_dir):
+        os.makedirs(pkg_dir)
+
+    obj_store = None
+    manifest = store.load_manifest(pkg_dir)
+    had_manifest = bool(manifest)
+    if store_path is not None:
+        obj_store = store.Store(store_path)
+
+    for k, res in entries:
+        if res is None:
+            continue
+
+        res.parse()
+
+        fn = element_fn(pkg_dir, res.fn, type(res) == SERI)
+
+        print('[+] Unpacking %i: "%s"' % (k, res.fn))
+        if obj_store is not None:
+            manifest[os.path.basename(fn)] = obj_store.write(res.parsed_for_file(), fn)
+            continue
+
+        store.unlink_shared(fn)
+        manifest.pop(os.path.basename(fn), None)
+        rfh = open(fn, "wb")
+        rfh.write(res.parsed_for_file())
+        rfh.close()
+
+    if manifest or had_manifest:
+        store.save_manifest(pkg_dir, manifest)
+    if obj_store is not None:
+        obj_store.save()
+        print(
+            "[+] Stored %d new resources, reused %d"
+            % (obj_store.added, obj_store.reused)
+        )
+        if obj_store.repaired > 0:
+            print(
+                "[-] Warning: %d stored resources had been edited in place, restored them"
+                % obj_store.repaired
+            )
+
+
+def repack_pkg(pkg, pkg_dir, dst_pkg, compact=False):
+    from img import store
+
+    manifest = store.load_manifest(pkg_dir)
+    shared_cnt = 0
+    for k, res in enumerate(pkg.entries):
+        if res is None:
+            continue
+
+        fn = element_fn(pkg_dir, res.fn, type(res) == SERI)
+        h = manifest.get(os.path.basename(fn))
+        if h is not None:
+            shared, edited = store.check(fn, h)
+            if shared > 0:
+                shared_cnt += 1
+            if edited:
+                print(
+                    '[-] Warning: "%s" was edited in place, %d other copies changed too'
+                    % (res.fn, shared)
+                )
+
+        fw = FileWindow(fn)
+        pkg.entries[k].fw = fw
+        pkg.entries[k].unparse()
+
+    if shared_cnt > 0:
+        print("[+] %d resources share storage with other packages" % shared_cnt)
+
+    if compact:
+        pkg.compact_strs = True
+
+    print("[+] Writing pkg")
+    nfh = open(dst_pkg, "wb")
+    pkg.write(nfh)
+    nfh.close()
+
+
+def unpack_img(entries, img_dir):
+    if not os.path.exists(img_dir):
+        os.makedirs(img_dir)
+
+    for k, res in entries:
+        if res is None:
+            continue
+
+        print('[+] Unpacking Idx "%04d"' % k)
+        rfh = open(package_fn(img_dir, k), "wb")
+        res.fw.seek(0x0)
+        rfh.write(res.fw.read())
+        rfh.close()
+
+
+def repack_img(img, entries, img_dir, dst_img, jobs=1):
+    for k, res in entries:
+        if res is None:
+            continue
+
+        new = os.path.exists(package_fn(img_dir, k, True))
+        fw = FileWindow(package_fn(img_dir, k, new))
+        img.entries[k].fw = fw
+
+    for k, res in enumerate(img.entries):
+        if res is None:
+            continue
+
+        img.entries[k].parse(False)
+
+    print("[+] Writing img")
+    nfh = open(dst_img, "wb")
+    img.write(nfh, jobs)
+    nfh.close()
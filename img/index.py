@@ -0,0 +1,336 @@
+import os, sys, array, bisect, struct
+
+from img import Package, FileWindow, SERI, TXT
+
+"""
+A persistent search index over the strings in every package.
+
+Covers StrTable strings, every key and string value in SERI data (Including
+FN_INDEX/ARR_FN_INDEX references) and the lines of TXT files. Each hit records
+the package index, the element name and the path within the SERI data.
+Substring queries go through a trigram index, exact ones through a dict.
+
+The index file only holds strings and arrays of numbers (See Notes.md), so
+loading it can't run code. Searching reads everything but the package
+signatures at the end.
+"""
+
+MAGIC = b"NIDX"
+VERSION = 2
+HEADER_FMT = "<4sI"
+HEADER_LEN = struct.calcsize(HEADER_FMT)
+
+
+def decode(s):
+    return s.decode("utf8", "replace") if isinstance(s, bytes) else str(s)
+
+
+def trigrams(s):
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+def seri_hits(data, path, hits):
+    """
+    Collect every key and string value of SERI data along with its path
+    """
+    if isinstance(data, dict):
+        for k, v in data.items():
+            k = decode(k)
+            kpath = path + "/" + k if path else k
+            hits.append((k, kpath))
+            seri_hits(v, kpath, hits)
+    elif isinstance(data, list):
+        for i, v in enumerate(data):
+            seri_hits(v, "%s[%d]" % (path, i), hits)
+    elif isinstance(data, bytes):
+        hits.append((decode(data), path))
+
+
+def package_hits(k, pkg):
+    """
+    Collect all the (string, pkg idx, element name, path) hits in a parsed package
+    """
+    hits = set()
+    for i in range(len(pkg.entries)):
+        elem = pkg.entries[i]
+        hits.add((elem.fn, k, elem.fn, ""))
+        try:
+            if type(elem) == SERI:
+                elem.parse()
+                elem_hits = []
+                seri_hits(elem.data, "", elem_hits)
+                for s, path in elem_hits:
+                    hits.add((s, k, elem.fn, path))
+            elif type(elem) == TXT:
+                for j, line in enumerate(elem.parsed().splitlines()):
+                    if line:
+                        hits.add((line, k, elem.fn, "line %d" % (j + 1)))
+        except Exception as e:
+            print('[-] Skipping "%s" in Idx "%04d": %s' % (elem.fn, k, e))
+
+    # Anything else in the StrTable isn't tied to an element
+    found = {hit[0] for hit in hits}
+    for s in pkg.str_table.data.split(b"\0"):
+        s = decode(s)
+        if s and s not in found:
+            hits.add((s, k, None, None))
+            found.add(s)
+
+    return sorted(hits, key=lambda hit: (hit[0], hit[2] or "", hit[3] or ""))
+
+
+def write_array(fh, typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    fh.write(struct.pack("<I", len(a)))
+    fh.write(a.tobytes())
+
+
+def read_array(fh, typecode):
+    (cnt,) = struct.unpack("<I", fh.read(4))
+    a = array.array(typecode)
+    data = fh.read(cnt * a.itemsize)
+    if len(data) != cnt * a.itemsize:
+        raise (Exception("Index file is truncated"))
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def write_strs(fh, strs):
+    offs = [0]
+    data = bytearray()
+    for s in strs:
+        data += s.encode("utf8", "surrogatepass")
+        offs.append(len(data))
+    write_array(fh, "B", data)
+    write_array(fh, "I", offs)
+
+
+def read_strs(fh):
+    data = read_array(fh, "B").tobytes()
+    offs = read_array(fh, "I")
+    return [
+        data[offs[i] : offs[i + 1]].decode("utf8", "surrogatepass")
+        for i in range(len(offs) - 1)
+    ]
+
+
+class Index(object):
+    def __init__(self):
+        self.pkgs = {}
+        self.strings = []
+        self.exact = {}
+        # Element names and SERI paths of the postings
+        self.names = []
+        # The postings of string i are post_k/elem/path[post_offs[i] : post_offs[i + 1]]
+        # post_elem and post_path index names, -1 is None
+        self.post_offs = array.array("I", [0])
+        self.post_k = array.array("I")
+        self.post_elem = array.array("i")
+        self.post_path = array.array("i")
+        # Sorted trigrams, the strings containing trigram i are tri_sids[tri_offs[i] : tri_offs[i + 1]]
+        self.tris = []
+        self.tri_offs = array.array("I", [0])
+        self.tri_sids = array.array("I")
+
+    def load(self, fn, pkgs=True):
+        """
+        Load an index file, returns False if it's from another version
+        The per-package hits that reindexing needs are only rebuilt if pkgs is set
+        """
+        fh = open(fn, "rb")
+        magic, version = struct.unpack(HEADER_FMT, fh.read(HEADER_LEN))
+        if magic != MAGIC or version != VERSION:
+            fh.close()
+            return False
+
+        self.strings = read_strs(fh)
+        self.exact = None
+        self.names = read_strs(fh)
+        self.post_offs = read_array(fh, "I")
+        self.post_k = read_array(fh, "I")
+        self.post_elem = read_array(fh, "i")
+        self.post_path = read_array(fh, "i")
+        self.tris = read_strs(fh)
+        self.tri_offs = read_array(fh, "I")
+        self.tri_sids = read_array(fh, "I")
+        if pkgs:
+            self.load_pkgs(fh)
+        fh.close()
+        return True
+
+    def load_pkgs(self, fh):
+        pkg_k = read_array(fh, "I")
+        pkg_fn = read_array(fh, "I")
+        pkg_off = read_array(fh, "Q")
+        pkg_len = read_array(fh, "Q")
+        pkg_mtime = read_array(fh, "q")
+
+        hits = {k: [] for k in pkg_k}
+        for sid, s in enumerate(self.strings):
+            for hit in self.postings(sid):
+                hits[hit[0]].append((s,) + hit)
+
+        self.pkgs = {}
+        for i, k in enumerate(pkg_k):
+            sig = (self.names[pkg_fn[i]], pkg_off[i], pkg_len[i], pkg_mtime[i])
+            pkg_hits = sorted(hits[k], key=lambda hit: (hit[0], hit[2] or "", hit[3] or ""))
+            self.pkgs[k] = (sig, pkg_hits)
+
+    def save(self, fn):
+        """
+        Save the index, build() has to be called first
+        """
+        name_ids = {s: i for i, s in enumerate(self.names)}
+        names = list(self.names)
+        pkg_k = sorted(self.pkgs)
+        pkg_fn = []
+        for k in pkg_k:
+            name = self.pkgs[k][0][0]
+            if name not in name_ids:
+                name_ids[name] = len(names)
+                names.append(name)
+            pkg_fn.append(name_ids[name])
+
+        fh = open(fn + ".tmp", "wb")
+        fh.write(struct.pack(HEADER_FMT, MAGIC, VERSION))
+        write_strs(fh, self.strings)
+        write_strs(fh, names)
+        write_array(fh, "I", self.post_offs)
+        write_array(fh, "I", self.post_k)
+        write_array(fh, "i", self.post_elem)
+        write_array(fh, "i", self.post_path)
+        write_strs(fh, self.tris)
+        write_array(fh, "I", self.tri_offs)
+        write_array(fh, "I", self.tri_sids)
+        # Only reindexing needs these, so they go last
+        write_array(fh, "I", pkg_k)
+        write_array(fh, "I", pkg_fn)
+        write_array(fh, "Q", [self.pkgs[k][0][1] for k in pkg_k])
+        write_array(fh, "Q", [self.pkgs[k][0][2] for k in pkg_k])
+        write_array(fh, "q", [self.pkgs[k][0][3] for k in pkg_k])
+        fh.close()
+        os.replace(fn + ".tmp", fn)
+
+    def update(self, k, res):
+        """
+        (Re)index a package if it changed since the last run. Returns whether it was indexed
+        """
+        st = os.stat(res.fw.filename)
+        sig = (res.fw.filename, res.fw.base_offset, res.fw.len(), st.st_mtime_ns)
+        if k in self.pkgs and self.pkgs[k][0] == sig:
+            return False
+
+        pkg = Package(FileWindow(res.fw.filename, res.fw.base_offset, res.fw.wlen), 0)
+        pkg.parse(False)
+        self.pkgs[k] = (sig, package_hits(k, pkg))
+        return True
+
+    def remove(self, k):
+        self.pkgs.pop(k, None)
+
+    def build(self):
+        """
+        Regenerate the lookup tables from the per-package hits
+        """
+        self.strings = []
+        self.exact = {}
+        self.names = []
+        name_ids = {}
+        postings = []
+        trigram_sets = {}
+
+        def name_id(name):
+            if name is None:
+                return -1
+            if name not in name_ids:
+                name_ids[name] = len(self.names)
+                self.names.append(name)
+            return name_ids[name]
+
+        for k in sorted(self.pkgs):
+            for hit in self.pkgs[k][1]:
+                s = hit[0]
+                sid = self.exact.get(s)
+                if sid is None:
+                    sid = self.exact[s] = len(self.strings)
+                    self.strings.append(s)
+                    postings.append([])
+                    for t in trigrams(s.casefold()):
+                        trigram_sets.setdefault(t, []).append(sid)
+                postings[sid].append((hit[1], name_id(hit[2]), name_id(hit[3])))
+
+        self.post_offs = array.array("I", [0])
+        self.post_k = array.array("I")
+        self.post_elem = array.array("i")
+        self.post_path = array.array("i")
+        for hits in postings:
+            for k, elem, path in hits:
+                self.post_k.append(k)
+                self.post_elem.append(elem)
+                self.post_path.append(path)
+            self.post_offs.append(len(self.post_k))
+
+        self.tris = sorted(trigram_sets)
+        self.tri_offs = array.array("I", [0])
+        self.tri_sids = array.array("I")
+        for t in self.tris:
+            self.tri_sids.extend(trigram_sets[t])
+            self.tri_offs.append(len(self.tri_sids))
+
+    def postings(self, sid):
+        """
+        The (pkg idx, element name, path) of every hit on string sid
+        """
+        ret = []
+        for i in range(self.post_offs[sid], self.post_offs[sid + 1]):
+            elem = self.post_elem[i]
+            path = self.post_path[i]
+            ret.append(
+                (
+                    self.post_k[i],
+                    None if elem < 0 else self.names[elem],
+                    None if path < 0 else self.names[path],
+                )
+            )
+        return ret
+
+    def trigram_sids(self, t):
+        i = bisect.bisect_left(self.tris, t)
+        if i == len(self.tris) or self.tris[i] != t:
+            return ()
+        return self.tri_sids[self.tri_offs[i] : self.tri_offs[i + 1]]
+
+    def search(self, query, exact=False):
+        """
+        Returns (string, pkg idx, element name, path) for every match
+        """
+        if exact:
+            # Only exact searches need the dict, so it's built on demand after a load
+            if self.exact is None:
+                self.exact = {s: i for i, s in enumerate(self.strings)}
+            sids = [self.exact[query]] if query in self.exact else []
+        else:
+            query = query.casefold()
+            tris = trigrams(query)
+            if not tris:
+                cands = range(len(self.strings))
+            else:
+                lists = sorted(
+                    (self.trigram_sids(t) for t in tris), key=lambda sids: len(sids)
+                )
+                cands = set(lists[0])
+                for sids in lists[1:]:
+                    cands.intersection_update(sids)
+                    if not cands:
+                        break
+            sids = sorted(sid for sid in cands if query in self.strings[sid].casefold())
+
+        ret = []
+        for sid in sids:
+            for hit in self.postings(sid):
+                ret.append((self.strings[sid],) + hit)
+        return ret
@@ -0,0 +1,316 @@
+import struct, zlib, hashlib, tempfile
+
+from img import Package
+
+"""
+Binary delta patches between two img files.
+
+A patch is a header followed by a list of ops that rebuild the new img front to
+back: COPY a range out of the source img, or insert (compressed) DATA. Only
+resources and package elements that changed end up as DATA.
+"""
+
+MAGIC = b"NPAT"
+VERSION = 1
+# SHA1 of the original img.bin (See Notes.md)
+ORIG_HASH = bytes.fromhex("77190d7bf672ff7d62c09018a8513989d22b967a")
+CHUNK_SIZE = 0x100000
+
+HEADER_FMT = "=4sI20s20sQ"
+HEADER_LEN = struct.calcsize(HEADER_FMT)
+OP_FMT = "=cII"
+OP_LEN = struct.calcsize(OP_FMT)
+
+OP_END = b"E"
+OP_COPY = b"C"
+OP_DATA = b"D"
+
+
+def element_spans(pkg):
+    """
+    The (offset, length) of the raw (possibly compressed) bytes of each element in a package
+    """
+    pkg.parse(False)
+    pkg_len = pkg.fw.len()
+    ret = []
+    for i in range(len(pkg.entries)):
+        off = pkg.entries.offs[i]
+        wlen = pkg.entries.lens[i]
+        # Uncompressed non-SERI entries point into the decompressed space, skip those
+        if wlen == 0 or off + wlen > pkg_len:
+            continue
+        ret.append((pkg.fw.base_offset + off, wlen))
+    return ret
+
+
+def resource_spans(img, img_len):
+    """
+    The (offset, length, element spans) of every resource in file order
+    Only package tables are read here, the data itself is left for the streaming pass
+    """
+    ret = []
+    for res in img.entries:
+        if res is None:
+            continue
+        off = res.fw.base_offset
+        wlen = res.fw.len()
+        if off + wlen > img_len:
+            continue
+
+        elems = []
+        if isinstance(res, Package):
+            elems = element_spans(res)
+        ret.append((off, wlen, elems))
+
+    ret.sort()
+    # Resources don't overlap in a valid img, skip any that do
+    spans = []
+    end = 0
+    for span in ret:
+        if span[0] >= end:
+            spans.append(span)
+            end = span[0] + span[1]
+    return spans
+
+
+def file_hash(fh):
+    fh.seek(0x0)
+    h = hashlib.sha1()
+    while True:
+        data = fh.read(CHUNK_SIZE)
+        if not data:
+            break
+        h.update(data)
+    return h.digest()
+
+
+class Reader(object):
+    """
+    Reads a file front to back exactly once, hashing everything that goes by
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.hash = hashlib.sha1()
+        self.pos = 0
+        fh.seek(0x0)
+
+    def chunks(self, wlen, hashes=()):
+        """
+        Yields the next wlen bytes in chunks, also feeding them into hashes
+        """
+        while wlen > 0:
+            data = self.fh.read(min(CHUNK_SIZE, wlen))
+            if not data:
+                raise (Exception("Img too short"))
+            self.hash.update(data)
+            for h in hashes:
+                h.update(data)
+            self.pos += len(data)
+            wlen -= len(data)
+            yield data
+
+    def read(self, wlen):
+        return next(self.chunks(wlen), b"")
+
+    def read_resource(self, off, wlen, elems, out=None):
+        """
+        Read the resource at off (The reader must not be past it), hashing it and each of its
+        elements. Elements may overlap. The resource bytes are also written to out, if given
+        Returns the resource hash and the (offset, length, hash) of each element
+        """
+        for data in self.chunks(off - self.pos):
+            pass
+
+        res_h = hashlib.sha1()
+        elem_hs = [hashlib.sha1() for _ in elems]
+        bounds = set([off + wlen])
+        for elem_off, elem_len in elems:
+            bounds.add(elem_off)
+            bounds.add(elem_off + elem_len)
+
+        for bound in sorted(bounds):
+            hashes = [res_h]
+            for (elem_off, elem_len), h in zip(elems, elem_hs):
+                if elem_off <= self.pos < elem_off + elem_len:
+                    hashes.append(h)
+            for data in self.chunks(bound - self.pos, hashes):
+                if out is not None:
+                    out.write(data)
+
+        return res_h.digest(), [
+            (elem_off, elem_len, h.digest())
+            for (elem_off, elem_len), h in zip(elems, elem_hs)
+        ]
+
+
+def scan(fh, img):
+    """
+    Hash a whole img file, each of its resources and each package element in one sequential pass
+    Returns the file hash, and the offset of every resource and element keyed by (length, hash)
+    """
+    fh.seek(0x0, 2)
+    img_len = fh.tell()
+    reader = Reader(fh)
+    res_offs = {}
+    elem_offs = {}
+
+    for off, wlen, elems in resource_spans(img, img_len):
+        h, elem_hashes = reader.read_resource(off, wlen, elems)
+        res_offs.setdefault((wlen, h), off)
+        for elem_off, elem_len, elem_h in elem_hashes:
+            elem_offs.setdefault((elem_len, elem_h), elem_off)
+
+    for data in reader.chunks(img_len - reader.pos):
+        pass
+    return reader.hash.digest(), res_offs, elem_offs
+
+
+class PatchWriter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.copy = None
+        self.data = bytearray()
+        self.copied = 0
+        self.inserted = 0
+
+    def write_header(self, src_hash, dst_hash, dst_len):
+        self.fh.write(struct.pack(HEADER_FMT, MAGIC, VERSION, src_hash, dst_hash, dst_len))
+
+    def write_copy(self, src_off, wlen):
+        if self.copy is not None and sum(self.copy) == src_off:
+            self.copy[1] += wlen
+        else:
+            self.flush()
+            self.copy = [src_off, wlen]
+        self.copied += wlen
+
+    def write_data(self, fh, wlen):
+        """
+        Insert the next wlen bytes of fh. Adjacent DATA is merged up to CHUNK_SIZE
+        """
+        if self.copy is not None:
+            self.flush()
+        while wlen > 0:
+            data = fh.read(min(CHUNK_SIZE - len(self.data), wlen))
+            if not data:
+                raise (Exception("Img too short"))
+            self.data += data
+            wlen -= len(data)
+            if len(self.data) == CHUNK_SIZE:
+                self.flush()
+
+    def flush(self):
+        if self.copy is not None:
+            self.fh.write(struct.pack(OP_FMT, OP_COPY, *self.copy))
+            self.copy = None
+        if self.data:
+            cmp_data = zlib.compress(self.data, level=9)
+            self.fh.write(struct.pack(OP_FMT, OP_DATA, len(self.data), len(cmp_data)))
+            self.fh.write(cmp_data)
+            self.inserted += len(self.data)
+            self.data = bytearray()
+
+    def write_end(self):
+        self.flush()
+        self.fh.write(struct.pack(OP_FMT, OP_END, 0x0, 0x0))
+
+
+def diff(src, dst, fh):
+    """
+    Write a patch that turns the img `src` into the img `dst` (Both parsed non-recursively)
+    fh has to be seekable. Returns the source hash and the number of copied and inserted bytes
+
+    Each img is read sequentially once, apart from the package tables. A changed resource is
+    spooled while it's hashed, so the DATA between its unchanged elements comes from the spool
+    """
+    src_fh = open(src.filename, "rb")
+    src_hash, src_res, src_elems = scan(src_fh, src)
+    src_fh.close()
+
+    dst_fh = open(dst.filename, "rb")
+    dst_fh.seek(0x0, 2)
+    dst_len = dst_fh.tell()
+    reader = Reader(dst_fh)
+
+    # The dst hash is only known at the end, so the header is filled in afterwards
+    writer = PatchWriter(fh)
+    writer.write_header(src_hash, b"\0" * 20, dst_len)
+
+    for off, wlen, elems in resource_spans(dst, dst_len):
+        writer.write_data(reader, off - reader.pos)
+
+        spool = tempfile.SpooledTemporaryFile(CHUNK_SIZE)
+        h, elem_hashes = reader.read_resource(off, wlen, elems, spool)
+        spool.seek(0x0)
+
+        src_off = src_res.get((wlen, h))
+        if src_off is not None:
+            writer.write_copy(src_off, wlen)
+            spool.close()
+            continue
+
+        pos = off
+        for elem_off, elem_len, elem_h in sorted(elem_hashes):
+            src_off = src_elems.get((elem_len, elem_h))
+            if src_off is None or elem_off < pos:
+                continue
+            writer.write_data(spool, elem_off - pos)
+            spool.seek(elem_len, 1)
+            writer.write_copy(src_off, elem_len)
+            pos = elem_off + elem_len
+        writer.write_data(spool, off + wlen - pos)
+        spool.close()
+
+    writer.write_data(reader, dst_len - reader.pos)
+    writer.write_end()
+    dst_fh.close()
+
+    end = fh.tell()
+    fh.seek(0x0)
+    writer.write_header(src_hash, reader.hash.digest(), dst_len)
+    fh.seek(end)
+
+    return src_hash, writer.copied, writer.inserted
+
+
+def read_header(fh):
+    magic, version, src_hash, dst_hash, dst_len = struct.unpack(
+        HEADER_FMT, fh.read(HEADER_LEN)
+    )
+    if magic != MAGIC or version != VERSION:
+        raise (Exception("Not a patch file"))
+    return src_hash, dst_hash, dst_len
+
+
+def apply(src_fh, fh, out):
+    """
+    Apply the ops of a patch (After read_header) to src_fh, streaming the result into out
+    Returns the hash and length of the output
+    """
+    h = hashlib.sha1()
+    dst_len = 0
+    while True:
+        op, a, b = struct.unpack(OP_FMT, fh.read(OP_LEN))
+        if op == OP_END:
+            break
+        elif op == OP_COPY:
+            src_fh.seek(a)
+            while b > 0:
+                data = src_fh.read(min(CHUNK_SIZE, b))
+                if not data:
+                    raise (Exception("Source img too short"))
+                out.write(data)
+                h.update(data)
+                b -= len(data)
+                dst_len += len(data)
+        elif op == OP_DATA:
+            data = zlib.decompress(fh.read(b))
+            assert len(data) == a
+            out.write(data)
+            h.update(data)
+            dst_len += len(data)
+        else:
+            raise (Exception("Unknown op: " + repr(op)))
+
+    return h.digest(), dst_len
@@ -0,0 +1,170 @@
+import os, hashlib
+
+"""
+A content addressed object store for unpacked data.
+
+Every payload is stored once under its SHA1 and hardlinked into place. Each
+unpacked directory gets a manifest mapping file names to their hashes, so a
+repack can tell which files share storage and which were edited in place.
+"""
+
+MANIFEST_FN = ".store"
+# Size, mtime and inode of each object as last verified, so reuse doesn't have to rehash it
+STATS_FN = ".stats"
+
+
+def data_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_hash(fn):
+    fh = open(fn, "rb")
+    h = data_hash(fh.read())
+    fh.close()
+    return h
+
+
+def stat_sig(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def remove(fn):
+    """
+    Remove fn, even if it's read-only. Windows refuses to remove those, so they're made writable
+    first. Other hardlinks share the mode there, put() makes objects read-only again on reuse
+    """
+    try:
+        os.remove(fn)
+    except PermissionError:
+        os.chmod(fn, 0o644)
+        os.remove(fn)
+
+
+def unlink_shared(fn):
+    """
+    Remove fn if it's a hardlink (Or a read-only leftover of one), so that writing to it
+    doesn't clobber the other copies
+    """
+    if os.path.exists(fn) and (os.stat(fn).st_nlink > 1 or not os.access(fn, os.W_OK)):
+        remove(fn)
+
+
+def load_manifest(path):
+    fn = os.path.join(path, MANIFEST_FN)
+    if not os.path.exists(fn):
+        return {}
+    import yaml
+
+    fh = open(fn, "r", encoding="utf8")
+    data = yaml.safe_load(fh)
+    fh.close()
+    return data or {}
+
+
+def save_manifest(path, manifest):
+    import yaml
+
+    fh = open(os.path.join(path, MANIFEST_FN), "w", encoding="utf8")
+    yaml.safe_dump(manifest, fh)
+    fh.close()
+
+
+class Store(object):
+    def __init__(self, path):
+        self.path = path
+        self.added = 0
+        self.reused = 0
+        self.repaired = 0
+        self.stats = None
+
+    def load_stats(self):
+        if self.stats is None:
+            self.stats = {}
+            fn = os.path.join(self.path, STATS_FN)
+            if os.path.exists(fn):
+                import yaml
+
+                fh = open(fn, "r", encoding="utf8")
+                self.stats = yaml.safe_load(fh) or {}
+                fh.close()
+        return self.stats
+
+    def save(self):
+        """
+        Save the object stats, if any were looked at
+        """
+        if self.stats is None:
+            return
+        import yaml
+
+        fh = open(os.path.join(self.path, STATS_FN), "w", encoding="utf8")
+        yaml.safe_dump(self.stats, fh)
+        fh.close()
+
+    def object_fn(self, h):
+        return os.path.join(self.path, h[:2], h[2:])
+
+    def put(self, data):
+        """
+        Add data to the store if it isn't there yet, returns its hash
+        Objects that were edited in place anyway (Despite being read-only) are rewritten
+        """
+        h = data_hash(data)
+        fn = self.object_fn(h)
+        stats = self.load_stats()
+        if os.path.exists(fn):
+            st = os.stat(fn)
+            # Only rehash objects that were touched since they were last verified
+            if st.st_size == len(data) and (
+                stats.get(h) == stat_sig(st) or file_hash(fn) == h
+            ):
+                if st.st_mode & 0o222:
+                    os.chmod(fn, 0o444)
+                stats[h] = stat_sig(os.stat(fn))
+                self.reused += 1
+                return h
+            # Files already linked to the edited object keep the edit
+            os.chmod(fn, 0o644)
+            self.repaired += 1
+        else:
+            self.added += 1
+
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        fh = open(fn + ".tmp", "wb")
+        fh.write(data)
+        fh.close()
+        os.replace(fn + ".tmp", fn)
+        # Editors have to replace linked files rather than write over them
+        os.chmod(fn, 0o444)
+        stats[h] = stat_sig(os.stat(fn))
+        return h
+
+    def link(self, h, fn):
+        """
+        Point fn at an object, falling back to a copy where hardlinks aren't supported
+        """
+        if os.path.lexists(fn):
+            remove(fn)
+        try:
+            os.link(self.object_fn(h), fn)
+        except OSError:
+            import shutil
+
+            shutil.copyfile(self.object_fn(h), fn)
+
+    def write(self, data, fn):
+        h = self.put(data)
+        self.link(h, fn)
+        return h
+
+
+def check(fn, h):
+    """
+    Check an unpacked file against its manifest entry
+    Returns (number of other files sharing its storage, whether it was edited in place)
+    """
+    st = os.stat(fn)
+    # One of the links is the store's own copy
+    shared = max(st.st_nlink - 2, 0)
+    edited = st.st_nlink > 1 and file_hash(fn) != h
+    return shared, edited
@@ -0,0 +1,156 @@
+import os, io, time
+
+from img import Package, FileWindow, SERI
+from img.cli import package_fn, element_fn
+
+"""
+Incrementally rebuilds an img as files under img_data/XXXX_data change.
+
+Packages are loaded the first time one of their element files changes. After
+that they're kept in memory along with the packed data of every element, so a
+change only repacks the elements that were touched.
+"""
+
+
+def scan_dir(path):
+    """
+    Snapshot the mtime and size of every file in a directory
+    """
+    ret = {}
+    if not os.path.isdir(path):
+        return ret
+    for entry in os.scandir(path):
+        if entry.is_file():
+            st = entry.stat()
+            ret[entry.name] = (st.st_mtime_ns, st.st_size)
+    return ret
+
+
+class Watcher(object):
+    def __init__(self, img, img_dir, dst_img, idxs):
+        self.img = img
+        self.img_dir = img_dir
+        self.dst_img = dst_img
+        self.idxs = idxs
+        self.pkgs = {}
+        self.mtimes = {}
+
+    def pkg_dir(self, i):
+        return package_fn(self.img_dir, i) + "_data"
+
+    def start(self):
+        """
+        Write out the initial img, picking up any packages that were already repacked
+        """
+        for k, res in enumerate(self.img.entries):
+            if res is None:
+                continue
+
+            new = os.path.exists(package_fn(self.img_dir, k, True))
+            fn = package_fn(self.img_dir, k, new)
+            if os.path.exists(fn):
+                res.fw = FileWindow(fn)
+            res.parse(False)
+
+        for k in self.idxs:
+            self.mtimes[k] = scan_dir(self.pkg_dir(k))
+
+        self.write_img()
+
+    def poll(self):
+        """
+        Check for changes and rebuild. Returns the list of rebuilt packages
+        """
+        rebuilt = []
+        for k in self.idxs:
+            curr = scan_dir(self.pkg_dir(k))
+            prev = self.mtimes[k]
+            self.mtimes[k] = curr
+
+            fns = [fn for fn, st in curr.items() if prev.get(fn) != st]
+            if not fns:
+                continue
+
+            t = time.time()
+            try:
+                cnt = self.rebuild(k, fns)
+            except Exception as e:
+                print('[-] Failed to rebuild Idx "%04d": %s' % (k, e))
+                continue
+            if cnt > 0:
+                rebuilt.append(k)
+                print(
+                    '[+] Rebuilt Idx "%04d" (%d elements) in %.2fs'
+                    % (k, cnt, time.time() - t)
+                )
+
+        if rebuilt:
+            t = time.time()
+            self.update_img(rebuilt)
+            print("[+] Updated img in %.2fs" % (time.time() - t))
+
+        return rebuilt
+
+    def rebuild(self, k, fns):
+        """
+        Repack the elements of package k backed by the files in fns
+        Returns the number of elements repacked
+        """
+        pkg_dir = self.pkg_dir(k)
+        pkg = self.pkgs.get(k)
+        load = pkg is None
+        if load:
+            pkg = Package(FileWindow(package_fn(self.img_dir, k)), self.img.entries[k].unk)
+            pkg.parse(False)
+
+        elem_fns = {}
+        for i in range(len(pkg.entries)):
+            elem = pkg.entries[i]
+            elem_fns[os.path.basename(element_fn(pkg_dir, elem.fn, type(elem) == SERI))] = i
+
+        changed = [elem_fns[fn] for fn in fns if fn in elem_fns]
+        if not changed:
+            return 0
+
+        # The first rebuild packs everything, later ones just the changed elements
+        if load:
+            changed = range(len(pkg.entries))
+            pkg.cache = {}
+        for i in changed:
+            elem = pkg.entries[i]
+            elem.fw = FileWindow(element_fn(pkg_dir, elem.fn, type(elem) == SERI))
+            pkg.cache.pop(i, None)
+
+        # Build in memory first so a bad edit doesn't clobber new_XXXX
+        buf = io.BytesIO()
+        pkg.write(buf)
+
+        new_fn = package_fn(self.img_dir, k, True)
+        nfh = open(new_fn, "wb")
+        nfh.write(buf.getvalue())
+        nfh.close()
+
+        pkg.fw = FileWindow(new_fn)
+        self.pkgs[k] = pkg
+        self.img.entries[k] = pkg
+        return len(changed)
+
+    def write_img(self):
+        nfh = open(self.dst_img, "wb")
+        self.img.write(nfh, os.cpu_count() or 1)
+        nfh.close()
+
+    def update_img(self, idxs):
+        nfh = open(self.dst_img, "rb+")
+        fits = all(self.img.update(nfh, k) for k in idxs)
+        nfh.close()
+
+        # A package outgrew its blocks, everything after it moves
+        if not fits:
+            print("[+] Rewriting img")
+            self.write_img()
+
+    def run(self, interval):
+        while True:
+            self.poll()
+            time.sleep(interval)